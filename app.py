@@ -1,5 +1,12 @@
    # app2.py — App principal Streamlit (router + páginas)
 import os
+import json
+import importlib
+import hashlib
+import shutil
+import time
+from collections import deque
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime
 import streamlit as st
@@ -34,14 +41,38 @@ def _rerun():
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+_MIME_EXT = {"image/jpeg": ".jpg", "image/jpg": ".jpg", "image/png": ".png"}
+
 def _save_uploaded_file(file, prefix: str) -> str:
     """Guarda un UploadedFile/camera_input y devuelve ruta local (str)."""
-    ext = ".png"
+    # Conserva el formato de origen (evita re-codificar JPEG como PNG más adelante)
+    ext = (Path(getattr(file, "name", "") or "").suffix.lower()
+           or _MIME_EXT.get(getattr(file, "type", ""), ".png"))
     name = f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
     dest = UPLOAD_DIR / name
-    dest.write_bytes(file.getbuffer())
+    file.seek(0)
+    with open(dest, "wb") as out:
+        shutil.copyfileobj(file, out, length=1024 * 1024)  # a disco en bloques de 1 MiB
     return str(dest)
 
+THUMB_DIR = UPLOAD_DIR / "thumbs"
+THUMB_DIR.mkdir(exist_ok=True)
+THUMB_SIZE = (256, 256)
+
+def _make_thumbnail(path: str) -> str | None:
+    """Genera una miniatura JPEG (~256 px) para las vistas de listado; None si no se puede."""
+    try:
+        from PIL import Image, ImageOps
+        dest = THUMB_DIR / f"{Path(path).stem}.jpg"
+        with Image.open(path) as img:
+            # Se aplica la orientación EXIF antes de reducir: la miniatura no conserva los metadatos
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail(THUMB_SIZE)
+            img.convert("RGB").save(dest, "JPEG", quality=80)
+        return str(dest)
+    except Exception:
+        return None
+
 def _safe_link_button(label: str, url: str, key: str | None = None):
     """Usa link_button si existe; si no, cae a un enlace normal."""
     try:
@@ -49,10 +80,48 @@ def _safe_link_button(label: str, url: str, key: str | None = None):
     except Exception:
         st.markdown(f"[{label}]({url})")
 
+# =========================
+# Lecturas cacheadas (SQLite)
+# =========================
+@st.cache_data(ttl=30)
+def _cached_list_user_items(username: str, status: str | None, order_by: str = "-created_at",
+                            limit: int | None = None, offset: int = 0) -> list[db.ItemRow]:
+    return db.list_user_items(username, status=status, order_by=order_by, limit=limit, offset=offset)
+
+@st.cache_data(ttl=30)
+def _cached_user_items_df(username: str, status: str, columns: tuple[str, ...]) -> pd.DataFrame:
+    return db.list_user_items_df(username, status, columns)
+
+@st.cache_data(ttl=30)
+def _cached_user_totals(username: str) -> dict[str, dict]:
+    return db.user_totals(username)
+
+# attrs["loaded_at"] marca cada recarga: el CSV ya preparado se descarta si los datos cambian
+@st.cache_data(ttl=30)
+def _cached_list_items_df() -> pd.DataFrame:
+    df = db.list_items_df()
+    df.attrs["loaded_at"] = time.time_ns()
+    return df
+
+@st.cache_data(ttl=30)
+def _cached_list_users_df() -> pd.DataFrame:
+    df = db.list_users_df()
+    df.attrs["loaded_at"] = time.time_ns()
+    return df
+
+def _invalidate_items_cache():
+    """Llamar tras cualquier escritura en items (create_item / update_item)."""
+    _cached_list_user_items.clear()
+    _cached_user_items_df.clear()
+    _cached_user_totals.clear()
+    _cached_list_items_df.clear()
+
 # =========================
 # API Key helpers (IA)
 # =========================
+@lru_cache(maxsize=1)
 def _get_api_key() -> str:
+    # Se resuelve una vez por proceso; usa _get_api_key.cache_clear() si cambia la clave
     # 1) app_secrets.py local
     try:
         from app_secrets import OPENAI_API_KEY as _KEY
@@ -71,31 +140,104 @@ def _get_api_key() -> str:
 def llm_available() -> bool:
     return bool(_get_api_key())
 
-def call_llm(messages, model="gpt-4o-mini", temperature=0.2, fallback=""):
+@lru_cache(maxsize=1)
+def _openai():
+    """Importa el SDK de OpenAI solo cuando hay clave (el modo demo no paga su import)."""
+    return importlib.import_module("openai")
+
+@lru_cache(maxsize=1)
+def _client():
+    """Cliente OpenAI único por proceso (reutiliza el pool de conexiones HTTP)."""
+    return _openai().OpenAI(api_key=_get_api_key())
+
+def _stream_text(resp):
+    """Convierte un stream de chat.completions en un generador de trozos de texto."""
+    try:
+        for chunk in resp:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        yield f"(IA no disponible: {e})"
+
+def call_llm(messages, model="gpt-4o-mini", temperature=0.2, fallback="", stream=False,
+             response_format=None):
     """
     Si no hay clave:
       - fallback == ""       → devuelve "" (no muestra nada)
       - fallback == "local"  → devuelve un mini-resumen demo
+    Con stream=True devuelve un generador de trozos de texto (para st.write_stream).
+    response_format se pasa tal cual a la API (p. ej. {"type": "json_object"}).
     """
     api_key = _get_api_key()
     if not api_key:
         if fallback == "local":
             last_user = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
-            return f"(demo) {last_user[:120]}..."
-        return ""  # silencioso
+            reply = f"(demo) {last_user[:120]}..."
+        else:
+            reply = ""  # silencioso
+        return iter([reply]) if stream else reply
 
     try:
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
+        client = _client()
         resp = client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
+            stream=stream,
+            **({"response_format": response_format} if response_format else {}),
         )
+        if stream:
+            return _stream_text(resp)
         return resp.choices[0].message.content
     except Exception as e:
         # No ruido técnico para el usuario final
-        return f"(IA no disponible: {e})"
+        reply = f"(IA no disponible: {e})"
+        return iter([reply]) if stream else reply
+
+def _stream_response_text(stream, on_response_id):
+    """Generador de texto desde un stream de la Responses API; guarda el id al terminar."""
+    try:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+            elif event.type == "response.completed":
+                on_response_id(event.response.id)
+            elif event.type in ("response.failed", "error"):
+                # Fallo notificado dentro del stream: se corta la cadena y se avisa (no respuesta vacía)
+                err = getattr(event.response, "error", None) if event.type == "response.failed" else event
+                on_response_id(None)
+                yield f"(IA no disponible: {getattr(err, 'message', None) or event.type})"
+                return
+    except Exception as e:
+        on_response_id(None)
+        yield f"(IA no disponible: {e})"
+
+def call_llm_turn(prompt, system_msg, window, previous_response_id=None, on_response_id=lambda _id: None,
+                  model="gpt-4o-mini", temperature=0.2):
+    """
+    Un turno de chat en streaming. Con la Responses API la conversación vive en el servidor
+    (previous_response_id) y solo se envía el mensaje nuevo; sin id previo se envía la ventana
+    (historial acotado) para abrir una cadena nueva. Si la API falla, se usa call_llm con la ventana.
+    """
+    if not _get_api_key():
+        return call_llm(window, model=model, temperature=temperature, fallback="local", stream=True)
+    try:
+        client = _client()
+        if previous_response_id:
+            kwargs = {"previous_response_id": previous_response_id, "input": prompt}
+        else:
+            kwargs = {"input": [m for m in window if m is not system_msg]}
+        stream = client.responses.create(
+            model=model,
+            instructions=system_msg["content"],
+            temperature=temperature,
+            stream=True,
+            **kwargs,
+        )
+    except Exception:
+        on_response_id(None)
+        return call_llm(window, model=model, temperature=temperature, fallback="local", stream=True)
+    return _stream_response_text(stream, on_response_id)
 
 # =========================
 # Chatbot UI
@@ -114,48 +256,66 @@ def chatbot_page():
     username = st.session_state.get("username", "usuario")
     role = st.session_state.get("role", "Viewer")
 
-    system_prompt = (
-        "Eres un asistente integrado en una app de Streamlit para estudiantes. "
-        "Ayuda con: (a) resumir/rewrite, (b) plan de estudio, "
-        "(c) explicar conceptos con ejemplos, "
-        "(d) sugerir SELECT SQL de solo lectura. "
-        f"Usuario: {username} | Rol: {role}."
-    )
-
-    if "chat_messages" not in st.session_state:
-        st.session_state["chat_messages"] = [{"role": "system", "content": system_prompt}]
+    # El prompt de sistema solo se recalcula si cambia (usuario, rol)
+    sys_key = (username, role)
+    if st.session_state.get("chat_system_key") != sys_key:
+        st.session_state["chat_system_key"] = sys_key
+        st.session_state["chat_prev_resp_id"] = None
+        st.session_state["chat_system_msg"] = {"role": "system", "content": (
+            "Eres un asistente integrado en una app de Streamlit para estudiantes. "
+            "Ayuda con: (a) resumir/rewrite, (b) plan de estudio, "
+            "(c) explicar conceptos con ejemplos, "
+            "(d) sugerir SELECT SQL de solo lectura. "
+            f"Usuario: {username} | Rol: {role}."
+        )}
+    system_msg = st.session_state["chat_system_msg"]
+
+    # Historial acotado: la ventana de contexto son directamente los últimos max_turns mensajes
+    msgs = st.session_state.get("chat_messages")
+    if not isinstance(msgs, deque):
+        msgs = deque(maxlen=max_turns)
+    elif msgs.maxlen != max_turns:
+        msgs = deque(msgs, maxlen=max_turns)
+    st.session_state["chat_messages"] = msgs
 
     c1, c2 = st.columns(2)
     with c1:
         st.button("🧹 Limpiar chat", key="clear_chat_btn",
-                  on_click=lambda: st.session_state.update(chat_messages=[{"role": "system", "content": system_prompt}]))
+                  on_click=lambda: (st.session_state["chat_messages"].clear(),
+                                    st.session_state.update(chat_prev_resp_id=None)))
     with c2:
         if llm_available():
             st.caption("IA activa ✅")
         else:
             st.caption("IA en modo demo (sin clave) · puedes activarla más tarde")
 
-    for m in st.session_state["chat_messages"]:
-        if m["role"] == "system":
-            continue
+    for m in msgs:
         with st.chat_message(m["role"]):
             st.markdown(m["content"])
 
     if prompt := st.chat_input("Escribe tu mensaje..."):
-        st.session_state["chat_messages"].append({"role": "user", "content": prompt})
+        msgs.append({"role": "user", "content": prompt})
+
+        # Ventana de contexto (solo se envía entera si no hay conversación en servidor)
+        window = [system_msg, *msgs]
 
-        # Ventana de contexto
-        window = st.session_state["chat_messages"][:1]
-        history = [m for m in st.session_state["chat_messages"][1:]]
-        if len(history) > max_turns:
-            history = history[-max_turns:]
-        window.extend(history)
+        # La cadena del servidor factura todos sus turnos: al superar max_turns mensajes se
+        # reinicia y se reenvía solo la ventana acotada
+        prev_id = st.session_state.get("chat_prev_resp_id")
+        if prev_id and st.session_state.get("chat_chain_len", 0) + 2 > max_turns:
+            prev_id = None
+        chain_len = st.session_state.get("chat_chain_len", 0) + 2 if prev_id else len(msgs) + 1
 
         with st.chat_message("assistant"):
-            reply = call_llm(window, temperature=temperature, fallback="local")
-            st.markdown(reply)
+            reply = st.write_stream(call_llm_turn(
+                prompt, system_msg, window,
+                previous_response_id=prev_id,
+                on_response_id=lambda rid: st.session_state.update(
+                    chat_prev_resp_id=rid, chat_chain_len=chain_len if rid else 0),
+                temperature=temperature,
+            ))
 
-        st.session_state["chat_messages"].append({"role": "assistant", "content": reply})
+        msgs.append({"role": "assistant", "content": reply})
 
 # =========================
 # CO2 helpers (inspirado en Base 44)
@@ -172,6 +332,12 @@ _TRANSPORT_FACTORS = {
     "España": 0.2, "Portugal": 0.3, "Francia": 0.4, "Italia": 0.4,
     "China": 1.5, "India": 1.4, "Bangladesh": 1.6, "Vietnam": 1.5, "Turquía": 0.8
 }
+_MATERIALS = ("cotton","polyester","wool","linen","silk","nylon","mixed","leather","other")
+_MATERIAL_IDX = {m: i for i, m in enumerate(_MATERIALS)}
+_CATEGORIES = ("shirt","pants","dress","jacket","coat","shoes","accessories","other")
+_CATEGORY_IDX = {c: i for i, c in enumerate(_CATEGORIES)}
+
+@lru_cache(maxsize=512)
 def estimate_co2(material: str, category: str, origin: str):
     mf = _MATERIAL_FACTORS.get(material or "other", _MATERIAL_FACTORS["other"])
     w  = _CATEGORY_WEIGHTS.get(category or "other", _CATEGORY_WEIGHTS["other"])
@@ -194,6 +360,7 @@ def upload_page():
     state.setdefault("upl_step", "choose")
     state.setdefault("upl_product_path", None)
     state.setdefault("upl_label_path", None)
+    state.setdefault("upl_thumb_path", None)
     state.setdefault("upl_data", {
         "brand": "Marca por identificar",
         "price": 50.0,
@@ -215,6 +382,7 @@ def upload_page():
             if f is not None:
                 path = _save_uploaded_file(f, "product")
                 state.upl_product_path = path
+                state.upl_thumb_path = _make_thumbnail(path)
                 state.upl_step = "label"
                 st.success("✅ Imagen cargada.")
                 _rerun()
@@ -224,6 +392,7 @@ def upload_page():
             if cam is not None:
                 path = _save_uploaded_file(cam, "product")
                 state.upl_product_path = path
+                state.upl_thumb_path = _make_thumbnail(path)
                 state.upl_step = "label"
                 st.success("✅ Foto capturada.")
                 _rerun()
@@ -254,12 +423,20 @@ def upload_page():
             hint = st.text_input("Pista breve (ej.: 'Zara camiseta algodón 19.99 hecha en España, blanca')",
                                  key="ia_hint")
             if st.button("Proponer datos", key="ia_propose"):
-                prompt = [
-                    {"role": "system",
-                     "content": "Devuelve JSON compactado con brand, price, origin, material, category, title, color (si conoces) y confidence (0-1)."},
-                    {"role": "user", "content": f"Pista: {hint}"}
-                ]
-                reply = call_llm(prompt, temperature=0.2, fallback="local")
+                # Misma pista que la última respondida → se reutiliza la respuesta (sin nueva llamada)
+                hint_key = hashlib.md5(hint.encode("utf-8"), usedforsecurity=False).hexdigest()
+                if state.get("ia_hint_key") == hint_key:
+                    reply = state["ia_hint_reply"]
+                else:
+                    prompt = [
+                        {"role": "system",
+                         "content": "Devuelve JSON compactado con brand, price, origin, material, category, title, color (si conoces) y confidence (0-1)."},
+                        {"role": "user", "content": f"Pista: {hint}"}
+                    ]
+                    reply = call_llm(prompt, temperature=0.2, fallback="local")
+                    # Solo se memoriza una respuesta real (no la demo ni un error), para poder reintentar
+                    if llm_available() and reply and not reply.startswith("(IA no disponible"):
+                        state.update(ia_hint_key=hint_key, ia_hint_reply=reply)
                 st.write("Sugerencia IA:")
                 st.code(reply)
                 st.info("Revisa/edita manualmente abajo.")
@@ -289,14 +466,14 @@ def upload_page():
             with col1:
                 data["material"] = st.selectbox(
                     "Material",
-                    ["cotton","polyester","wool","linen","silk","nylon","mixed","leather","other"],
-                    index=["cotton","polyester","wool","linen","silk","nylon","mixed","leather","other"].index(data["material"])
+                    _MATERIALS,
+                    index=_MATERIAL_IDX.get(data["material"], _MATERIAL_IDX["other"])
                 )
             with col2:
                 data["category"] = st.selectbox(
                     "Categoría",
-                    ["shirt","pants","dress","jacket","coat","shoes","accessories","other"],
-                    index=["shirt","pants","dress","jacket","coat","shoes","accessories","other"].index(data["category"])
+                    _CATEGORIES,
+                    index=_CATEGORY_IDX.get(data["category"], _CATEGORY_IDX["other"])
                 )
 
             co2, lvl = estimate_co2(data["material"], data["category"], data["origin"])
@@ -315,6 +492,7 @@ def upload_page():
                     category=data["category"],
                     image_path=state.upl_product_path,
                     label_image_path=state.upl_label_path,
+                    thumb_path=state.upl_thumb_path,
                     co2_estimate=co2,
                     co2_level=lvl,
                     status="in_cart",
@@ -322,12 +500,14 @@ def upload_page():
                     color=(data.get("color") or None),
                     confidence=float(data.get("confidence") or 0.0),
                 )
+                _invalidate_items_cache()
                 st.success("Producto guardado en tu carrito inteligente.")
                 # Preparar salto a Alternativas o Carrito
                 st.session_state["alt_last_item_id"] = item_id
                 st.session_state.upl_step = "choose"
                 st.session_state.upl_product_path = None
                 st.session_state.upl_label_path = None
+                st.session_state.upl_thumb_path = None
                 st.session_state.upl_data = {
                     "brand": "Marca por identificar", "price": 50.0, "origin": "Desconocido",
                     "material": "other", "category": "other", "title": "Prenda", "color": "", "confidence": 0.0
@@ -357,6 +537,7 @@ def upload_page():
 # =========================
 # Página: Alternativas (segunda mano)
 # =========================
+@st.cache_data(max_entries=256)
 def _mk_search_links(brand, category, color):
     term = " ".join([x for x in [brand, category, color] if x]).strip()
     q = term.replace(" ", "+")
@@ -376,14 +557,14 @@ def alternatives_page(item_id: int):
 
     cols = st.columns([1, 2])
     with cols[0]:
-        if item.get("image_path"):
-            st.image(item["image_path"], caption=item["title"], use_container_width=True)
-        st.write(f"**{item['brand']}** · €{item['price']:.2f}")
-        st.caption(f"CO₂ estimado: {item['co2_estimate']} kg ({item['co2_level']})")
+        if item.thumb_path or item.image_path:
+            st.image(item.thumb_path or item.image_path, caption=item.title, use_container_width=True)
+        st.write(f"**{item.brand}** · €{item.price:.2f}")
+        st.caption(f"CO₂ estimado: {item.co2_estimate} kg ({item.co2_level})")
     with cols[1]:
         st.info("Pulsa para abrir la búsqueda en marketplaces y añade alternativas similares a tu carrito.")
 
-        links = _mk_search_links(item.get("brand",""), item.get("category",""), item.get("color",""))
+        links = _mk_search_links(item.brand, item.category, item.color)
         c1,c2,c3,c4 = st.columns(4)
         _safe_link_button("Vinted", links["Vinted"], key="lk_vinted")
         _safe_link_button("Wallapop", links["Wallapop"], key="lk_wallapop")
@@ -395,7 +576,7 @@ def alternatives_page(item_id: int):
         colA, colB, colC = st.columns([2,1,1])
         with colA:
             alt_title = st.text_input("Título",
-                value=f"{item['brand']} {item['category']} - segunda mano",
+                value=f"{item.brand} {item.category} - segunda mano",
                 key=f"alt_title_{item_id}")
         with colB:
             factor = st.slider("Precio %", 30, 80, 60,
@@ -405,18 +586,20 @@ def alternatives_page(item_id: int):
             add_alt = st.button("➕ Añadir", key=f"add_alt_{item_id}")
 
         if add_alt:
-            alt_price = round(item["price"] * (factor/100), 2)
+            alt_price = round(item.price * (factor/100), 2)
             _id = db.create_item(
                 created_by=st.session_state.get("username","anon"),
                 source="second_hand",
-                title=alt_title, brand=item.get("brand",""),
-                price=alt_price, origin=item.get("origin","Desconocido"),
-                material=item.get("material","other"), category=item.get("category","other"),
-                image_path=item.get("image_path"), label_image_path=None,
-                co2_estimate=round(item.get("co2_estimate",0)*0.3,3), co2_level="low",
+                title=alt_title, brand=item.brand,
+                price=alt_price, origin=item.origin,
+                material=item.material, category=item.category,
+                image_path=item.image_path, label_image_path=None,
+                thumb_path=item.thumb_path,
+                co2_estimate=round((item.co2_estimate or 0)*0.3,3), co2_level="low",
                 status="in_cart", action_type="none",
-                color=item.get("color"), confidence=0.0,
+                color=item.color, confidence=0.0,
             )
+            _invalidate_items_cache()
             st.success(f"Alternativa añadida al carrito (id={_id}).")
 
         st.divider()
@@ -428,73 +611,121 @@ def alternatives_page(item_id: int):
 # =========================
 # Página: Smart Cart
 # =========================
+CART_PAGE_SIZE = 10
+
 def smart_cart_page():
     st.header("🛒 Smart Shopping Cart")
 
     username = st.session_state.get("username","anon")
-    items = db.list_user_items(username, status="in_cart", order_by="-created_at")
-
-    if not items:
+    total = _cached_user_totals(username)["in_cart"]["count"]
+    if not total:
         st.info("Tu carrito está vacío. Sube una imagen en **Subir prenda**.")
         return
 
+    # Paginación: solo se consulta y renderiza la página visible
+    offset = min(st.session_state.get("cart_offset", 0), (total - 1) // CART_PAGE_SIZE * CART_PAGE_SIZE)
+    items = _cached_list_user_items(username, "in_cart", "-created_at", CART_PAGE_SIZE, offset)
+
+    p1, p2, p3 = st.columns([1, 2, 1])
+    with p1:
+        st.button("⬅️ Anterior", key="cart_prev", disabled=offset == 0,
+                  on_click=lambda: st.session_state.update(cart_offset=max(offset - CART_PAGE_SIZE, 0)))
+    with p2:
+        st.caption(f"{offset + 1}–{offset + len(items)} de {total}")
+    with p3:
+        st.button("Siguiente ➡️", key="cart_next", disabled=offset + CART_PAGE_SIZE >= total,
+                  on_click=lambda: st.session_state.update(cart_offset=offset + CART_PAGE_SIZE))
+
     for it in items:
         with st.container():
             cols = st.columns([1, 3, 2])
             with cols[0]:
-                if it.get("image_path"):
-                    st.image(it["image_path"], caption=None, use_container_width=True)
+                if it.thumb_path or it.image_path:
+                    st.image(it.thumb_path or it.image_path, caption=None, use_container_width=True)
             with cols[1]:
-                st.markdown(f"**{it['title']}**")
-                st.caption(f"{it.get('brand','')} · €{it['price']:.2f}")
-                st.caption(f"Material: {it.get('material','?')} · CO₂: {it.get('co2_estimate',0)} kg ({it.get('co2_level','')})")
+                st.markdown(f"**{it.title}**")
+                st.caption(f"{it.brand} · €{it.price:.2f}")
+                st.caption(f"Material: {it.material} · CO₂: {it.co2_estimate} kg ({it.co2_level})")
             with cols[2]:
                 st.write("Acción")
                 act = st.radio(
                     "Elige acción",
                     ["—", "He comprado el original", "He ahorrado el dinero", "He comprado segunda mano"],
-                    key=f"act_{it['id']}",
+                    key=f"act_{it.id}",
                     label_visibility="collapsed",
                 )
                 if act == "He comprado el original":
-                    if st.button("Confirmar", key=f"neg_{it['id']}"):
-                        db.update_item(it["id"], status="negative",
+                    if st.button("Confirmar", key=f"neg_{it.id}"):
+                        db.update_item(it.id, status="negative",
                                        action_type="bought_original",
                                        savings=None, second_hand_price=None)
+                        _invalidate_items_cache()
                         st.success("Acción registrada (negativa).")
                         _rerun()
 
                 elif act == "He ahorrado el dinero":
-                    if st.button("Confirmar", key=f"save_{it['id']}"):
-                        db.update_item(it["id"], status="positive",
+                    if st.button("Confirmar", key=f"save_{it.id}"):
+                        db.update_item(it.id, status="positive",
                                        action_type="saved_money",
-                                       savings=it["price"], second_hand_price=None)
+                                       savings=it.price, second_hand_price=None)
+                        _invalidate_items_cache()
                         st.success("Acción registrada (positiva).")
                         _rerun()
 
                 elif act == "He comprado segunda mano":
-                    sp = st.number_input("Precio segunda mano (€)", min_value=0.0, step=0.5, key=f"sp_{it['id']}")
-                    if st.button("Confirmar", key=f"2h_{it['id']}"):
-                        savings = max(it["price"] - float(sp), 0.0)
-                        db.update_item(it["id"], status="positive",
+                    sp = st.number_input("Precio segunda mano (€)", min_value=0.0, step=0.5, key=f"sp_{it.id}")
+                    if st.button("Confirmar", key=f"2h_{it.id}"):
+                        savings = max(it.price - float(sp), 0.0)
+                        db.update_item(it.id, status="positive",
                                        action_type="bought_second_hand",
                                        savings=savings, second_hand_price=float(sp))
+                        _invalidate_items_cache()
                         st.success("Acción registrada (positiva, 2ª mano).")
                         _rerun()
 
 # =========================
 # Página: Métricas
 # =========================
+_CO2_DETAIL_COLS = {"id": "id", "title": "título", "co2_estimate": "CO₂", "co2_level": "nivel"}
+
+def _items_df(username: str, status: str, cols: dict[str, str]) -> pd.DataFrame:
+    """Detalle proyectado en SQL directamente a DataFrame, renombrando {columna: etiqueta}."""
+    return _cached_user_items_df(username, status, tuple(cols)).rename(columns=cols)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _metrics_ia_summary(totals_key: tuple) -> dict:
+    """Resúmenes IA (económico + ambiental) en un único request JSON, memoizados por totales."""
+    total_savings, n_pos, total_spent, n_neg, co2_pos, co2_neg = totals_key
+    txt = call_llm([
+        {"role":"system","content":"Devuelve solo JSON con las claves 'economico' (≤60 palabras, empático y práctico) "
+                                   "y 'ambiental' (≤60 palabras, inspirador y educativo)."},
+        {"role":"user","content": f"Ahorros: €{total_savings:.2f} en {n_pos} acciones; Gasto original: €{total_spent:.2f} en {n_neg} compras. "
+                                  f"CO₂ evitado {co2_pos:.2f} kg ({n_pos} acciones), CO₂ generado {co2_neg:.2f} kg ({n_neg} compras)."}
+    ], response_format={"type": "json_object"})
+    ia = json.loads(txt or "{}")  # ValueError (error de API / no JSON) → no se cachea
+    if not isinstance(ia, dict):
+        raise ValueError("respuesta IA sin objeto JSON")
+    return ia
+
 def metrics_page():
     st.header("📈 Métricas")
     username = st.session_state.get("username","anon")
-    pos = db.list_user_items(username, status="positive", order_by="-created_at")
-    neg = db.list_user_items(username, status="negative", order_by="-created_at")
-
-    total_savings = sum([(x.get("savings") or 0) for x in pos])
-    total_spent   = sum([(x.get("price") or 0) for x in neg])
-    co2_pos = sum([(x.get("co2_estimate") or 0) for x in pos])
-    co2_neg = sum([(x.get("co2_estimate") or 0) for x in neg])
+    totals = _cached_user_totals(username)
+    pos_t, neg_t = totals["positive"], totals["negative"]
+
+    total_savings = pos_t["savings"]
+    total_spent   = neg_t["price"]
+    co2_pos = pos_t["co2"]
+    co2_neg = neg_t["co2"]
+    n_pos, n_neg = pos_t["count"], neg_t["count"]
+
+    # Un único request a la IA para ambos resúmenes; los reruns (p. ej. "Ver detalle") no repiten la llamada
+    ia = {}
+    if llm_available():
+        try:
+            ia = _metrics_ia_summary((total_savings, n_pos, total_spent, n_neg, co2_pos, co2_neg))
+        except ValueError:
+            ia = {}
 
     tabs = st.tabs(["Económico", "Ambiental"])
 
@@ -504,30 +735,23 @@ def metrics_page():
         c1.metric("💚 Ahorro total", f"€{total_savings:.2f}")
         c2.metric("🟥 Gasto en originales", f"€{total_spent:.2f}")
 
-        st.subheader("Acciones positivas")
-        df_pos = pd.DataFrame([{
-            "id": x["id"], "título": x["title"], "ahorro": x.get("savings",0.0),
-            "tipo": x.get("action_type",""), "fecha": x.get("created_at","")
-        } for x in pos])
-        st.dataframe(df_pos, use_container_width=True)
+        # st.tabs ejecuta ambos cuerpos: el detalle solo se carga bajo demanda
+        if st.checkbox("Ver detalle", key="metrics_detail_eco"):
+            st.subheader("Acciones positivas")
+            df_pos = _items_df(username, "positive", {"id": "id", "title": "título", "savings": "ahorro",
+                                       "action_type": "tipo", "created_at": "fecha"})
+            st.dataframe(df_pos, use_container_width=True)
 
-        st.subheader("Compras originales")
-        df_neg = pd.DataFrame([{
-            "id": x["id"], "título": x["title"], "precio": x.get("price",0.0),
-            "fecha": x.get("created_at","")
-        } for x in neg])
-        st.dataframe(df_neg, use_container_width=True)
+            st.subheader("Compras originales")
+            df_neg = _items_df(username, "negative", {"id": "id", "title": "título", "price": "precio",
+                                       "created_at": "fecha"})
+            st.dataframe(df_neg, use_container_width=True)
 
-        if llm_available():
-            txt = call_llm([
-                {"role":"system","content":"Responde con ≤60 palabras, empático y práctico."},
-                {"role":"user","content": f"Ahorros: €{total_savings:.2f} en {len(pos)} acciones; Gasto original: €{total_spent:.2f} en {len(neg)} compras."}
-            ])
-            if txt:
-                st.info(f"🧠 IA: {txt}")
+        if ia.get("economico"):
+            st.info(f"🧠 IA: {ia['economico']}")
         else:
-            st.info(f"🧮 Resumen: Ahorros €{total_savings:.2f} ({len(pos)} acciones) · "
-                    f"Gasto original €{total_spent:.2f} ({len(neg)} compras)")
+            st.info(f"🧮 Resumen: Ahorros €{total_savings:.2f} ({n_pos} acciones) · "
+                    f"Gasto original €{total_spent:.2f} ({n_neg} compras)")
 
     # --- Ambiental ---
     with tabs[1]:
@@ -535,33 +759,37 @@ def metrics_page():
         c1.metric("🌿 CO₂ evitado", f"{co2_pos:.2f} kg")
         c2.metric("🔥 CO₂ generado", f"{co2_neg:.2f} kg")
 
-        st.subheader("Detalle positivo (CO₂)")
-        df_pos2 = pd.DataFrame([{
-            "id": x["id"], "título": x["title"], "CO₂": x.get("co2_estimate",0.0),
-            "nivel": x.get("co2_level","")
-        } for x in pos])
-        st.dataframe(df_pos2, use_container_width=True)
+        if st.checkbox("Ver detalle", key="metrics_detail_co2"):
+            st.subheader("Detalle positivo (CO₂)")
+            df_pos2 = _items_df(username, "positive", _CO2_DETAIL_COLS)
+            st.dataframe(df_pos2, use_container_width=True)
 
-        st.subheader("Detalle negativo (CO₂)")
-        df_neg2 = pd.DataFrame([{
-            "id": x["id"], "título": x["title"], "CO₂": x.get("co2_estimate",0.0),
-            "nivel": x.get("co2_level","")
-        } for x in neg])
-        st.dataframe(df_neg2, use_container_width=True)
+            st.subheader("Detalle negativo (CO₂)")
+            df_neg2 = _items_df(username, "negative", _CO2_DETAIL_COLS)
+            st.dataframe(df_neg2, use_container_width=True)
 
-        if llm_available():
-            txt = call_llm([
-                {"role":"system","content":"Responde con ≤60 palabras, inspirador y educativo."},
-                {"role":"user","content": f"CO₂ evitado {co2_pos:.2f} kg ({len(pos)} acciones), CO₂ generado {co2_neg:.2f} kg ({len(neg)} compras)."}
-            ])
-            if txt:
-                st.info(f"🧠 IA: {txt}")
+        if ia.get("ambiental"):
+            st.info(f"🧠 IA: {ia['ambiental']}")
         else:
             st.info(f"🧮 Resumen: CO₂ evitado {co2_pos:.2f} kg · CO₂ generado {co2_neg:.2f} kg")
 
 # =========================
 # Página: Admin (ver usuarios e items)
 # =========================
+def _lazy_csv_download(label: str, df: pd.DataFrame, file_name: str, key: str):
+    """Serializa el CSV solo cuando se pide (botón 'Preparar'), no en cada render."""
+    data_key = f"{key}_csv"
+    stamp = df.attrs.get("loaded_at")
+    if st.button("Preparar exportación", key=f"{key}_prep"):
+        st.session_state[data_key] = (stamp, df.to_csv(index=False).encode("utf-8"))
+    prepared = st.session_state.get(data_key)
+    if prepared is not None and prepared[0] != stamp:
+        # Los datos se han recargado desde que se preparó: no se ofrece un CSV obsoleto
+        st.session_state.pop(data_key, None)
+        prepared = None
+    if prepared is not None:
+        st.download_button(label, prepared[1], file_name, "text/csv", key=key)
+
 def admin_db_view():
     st.header("🛠️ Admin · Base de datos")
     st.caption("Ruta del fichero SQLite:")
@@ -570,32 +798,36 @@ def admin_db_view():
     c1, c2 = st.columns(2)
     with c1:
         st.subheader("Usuarios")
-        st.caption(f"Total usuarios: {db.count_users()}")
-        df_users = db.list_users_df()
+        df_users = _cached_list_users_df()
+        st.caption(f"Total usuarios: {len(df_users)}")
         st.dataframe(df_users, use_container_width=True)
-        st.download_button("⬇️ Exportar usuarios",
-                           df_users.to_csv(index=False).encode("utf-8"),
-                           "users.csv", "text/csv", key="dl_users")
+        _lazy_csv_download("⬇️ Exportar usuarios", df_users, "users.csv", key="dl_users")
     with c2:
         st.subheader("Items")
-        st.caption(f"Total items: {db.count_items()}")
-        df_items = db.list_items_df()
+        df_items = _cached_list_items_df()
+        st.caption(f"Total items: {len(df_items)}")
         st.dataframe(df_items, use_container_width=True)
-        st.download_button("⬇️ Exportar items",
-                           df_items.to_csv(index=False).encode("utf-8"),
-                           "items.csv", "text/csv", key="dl_items")
+        _lazy_csv_download("⬇️ Exportar items", df_items, "items.csv", key="dl_items")
 
 # =========================
 # Router principal
 # =========================
-def main():
-    # Init BD y seed de ejemplo
+SEED_USERS = {
+    "mario": {"password": "1234", "role": "Admin"},
+    "lucas": {"password": "abcd", "role": "Manager"},
+    "irene": {"password": "pass", "role": "Viewer"},
+}
+
+@st.cache_resource
+def _bootstrap() -> bool:
+    # Init BD y seed de ejemplo: una sola vez por proceso, no en cada rerun
     db.init_db()
-    db.seed_initial_users({
-        "mario": {"password": "1234", "role": "Admin"},
-        "lucas": {"password": "abcd", "role": "Manager"},
-        "irene": {"password": "pass", "role": "Viewer"},
-    })
+    db.seed_initial_users(SEED_USERS)
+    return True
+
+def main():
+    st.session_state.pop("_now", None)  # "ahora" de auth_ui se fija una vez por rerun
+    _bootstrap()
 
     st.sidebar.title("SpendSense")
     if not is_authenticated():
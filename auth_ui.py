@@ -1,7 +1,6 @@
 # auth_ui2.py — UI de autenticación: login, sign-up, cambio de contraseña, logout
-import re
 import streamlit as st
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 import db  # capa SQLite
 
 # --- Rerun compatible con todas las versiones de Streamlit ---
@@ -22,23 +21,28 @@ GLOBAL_LOCK_MINUTES = 15
 PASSWORD_EXPIRY_DAYS = 90  # 0 para desactivar
 
 # ---------- Utilidades ----------
-def now_utc_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
+def now_utc() -> datetime:
+    # Un único "ahora" por rerun (main() limpia st.session_state["_now"] al empezar)
+    if "_now" not in st.session_state:
+        st.session_state["_now"] = datetime.now(timezone.utc)
+    return st.session_state["_now"]
 
-def parse_iso(dt_str: str) -> datetime:
-    try:
-        return datetime.fromisoformat(dt_str)
-    except Exception:
-        return datetime.strptime(dt_str, "%Y-%m-%dT%H:%M:%S")
+def now_ts() -> float:
+    return now_utc().timestamp()
 
 def validate_password(password: str) -> bool:
     if len(password) < 8:
         return False
-    if not re.search(r"[A-Z]", password):
-        return False
-    if not re.search(r"[^A-Za-z0-9]", password):
-        return False
-    return True
+    # Una sola pasada: mayúscula [A-Z] y carácter especial [^A-Za-z0-9]
+    has_upper = has_special = False
+    for c in password:
+        if "A" <= c <= "Z":
+            has_upper = True
+        elif not ("a" <= c <= "z" or "0" <= c <= "9"):
+            has_special = True
+        if has_upper and has_special:
+            return True
+    return False
 
 # ---------- Guardas globales ----------
 def init_global_guard():
@@ -49,11 +53,11 @@ def init_global_guard():
 
 def is_global_locked() -> tuple[bool, str | None]:
     init_global_guard()
-    lock_until = st.session_state.get("global_lock_until")
+    lock_until = st.session_state.get("global_lock_until")  # epoch (s)
     if lock_until:
-        dt = parse_iso(lock_until)
-        if datetime.now(timezone.utc) < dt.astimezone(timezone.utc):
-            minutes_left = int((dt - datetime.now(timezone.utc)).total_seconds() // 60) + 1
+        now = now_ts()
+        if now < lock_until:
+            minutes_left = int((lock_until - now) // 60) + 1
             return True, f"Acceso global bloqueado. Intenta en ~{minutes_left} min."
         else:
             st.session_state["global_lock_until"] = None
@@ -65,9 +69,7 @@ def register_global_fail():
     init_global_guard()
     st.session_state["global_failed_attempts"] += 1
     if st.session_state["global_failed_attempts"] >= GLOBAL_MAX_FAILED_ATTEMPTS:
-        st.session_state["global_lock_until"] = (
-            datetime.now(timezone.utc) + timedelta(minutes=GLOBAL_LOCK_MINUTES)
-        ).isoformat()
+        st.session_state["global_lock_until"] = now_ts() + GLOBAL_LOCK_MINUTES * 60
 
 def reset_global_fail():
     init_global_guard()
@@ -75,32 +77,22 @@ def reset_global_fail():
     st.session_state["global_lock_until"] = None
 
 # ---------- Lock y expiración por usuario ----------
-def is_locked(user_data: dict) -> tuple[bool, str | None]:
-    lock_until = user_data.get("lock_until")
-    if lock_until:
-        try:
-            dt = parse_iso(lock_until)
-            if datetime.now(timezone.utc) < dt.astimezone(timezone.utc):
-                minutes_left = int((dt - datetime.now(timezone.utc)).total_seconds() // 60) + 1
-                return True, f"Cuenta bloqueada. Intenta en ~{minutes_left} min."
-            else:
-                db.reset_failed_attempts(user_data["username"])
-                return False, None
-        except Exception:
-            return False, None
+def is_locked(user_data: db.UserRow) -> tuple[bool, str | None]:
+    # lock_state viene calculado por SQLite en get_user
+    if user_data.lock_state == db.LOCK_ACTIVE:
+        minutes_left = max(int((user_data.lock_until_ts - now_ts()) // 60), 0) + 1
+        return True, f"Cuenta bloqueada. Intenta en ~{minutes_left} min."
+    if user_data.lock_state == db.LOCK_EXPIRED:
+        db.clear_lock_if_expired(user_data.username)
     return False, None
 
-def is_password_expired(user_data: dict) -> bool:
+def is_password_expired(user_data: db.UserRow) -> bool:
     if PASSWORD_EXPIRY_DAYS <= 0:
         return False
-    last_set_iso = user_data.get("password_last_set")
-    if not last_set_iso:
-        return True
-    try:
-        last_set = parse_iso(last_set_iso)
-    except Exception:
+    last_set = user_data.password_last_set_ts
+    if not last_set:
         return True
-    return datetime.now(timezone.utc) >= (last_set.astimezone(timezone.utc) + timedelta(days=PASSWORD_EXPIRY_DAYS))
+    return now_ts() >= last_set + PASSWORD_EXPIRY_DAYS * 86400
 
 # ---------- Sesión ----------
 def is_authenticated() -> bool:
@@ -185,12 +177,12 @@ def show_login():
         st.error(f"⛔ {msg}")
         return
 
-    ok, _ = db.authenticate(username, password)
+    ok, _ = db.authenticate(username, password, user_data)
     if not ok:
-        db.register_failed_attempt(username, MAX_FAILED_ATTEMPTS, LOCKOUT_MINUTES)
+        after = db.register_failed_attempt(username, MAX_FAILED_ATTEMPTS, LOCKOUT_MINUTES)
         register_global_fail()
 
-        after_user = int(user_data.get("failed_attempts", 0)) + 1
+        after_user = after[0] if after else user_data.failed_attempts + 1
         remaining_user = max(0, MAX_FAILED_ATTEMPTS - after_user)
         remaining_global = max(0, GLOBAL_MAX_FAILED_ATTEMPTS - st.session_state["global_failed_attempts"])
 
@@ -212,7 +204,7 @@ def show_login():
 
     st.session_state["logged_in"] = True
     st.session_state["username"] = username
-    st.session_state["role"] = user_data.get("role", "Viewer")
+    st.session_state["role"] = user_data.role or "Viewer"
     st.success(f"✅ Bienvenido {username}!")
     _rerun()
 
@@ -250,13 +242,12 @@ def show_change_password(username: str, force: bool = False):
         st.error("⚠️ La nueva contraseña no cumple los requisitos (mín. 8, 1 mayúscula, 1 carácter especial).")
         return
 
-    db.set_new_password(username, new_pw)
+    role = db.set_new_password(username, new_pw)
     reset_global_fail()
     st.success("✅ Contraseña actualizada correctamente.")
     st.session_state["must_change_password"] = False
     st.session_state["logged_in"] = True
-    fresh = db.get_user(username)
-    st.session_state["role"] = fresh.get("role", "Viewer") if fresh else "Viewer"
+    st.session_state["role"] = role or "Viewer"
     _rerun()
 
 # ---------- UI: Logout ----------
@@ -1,31 +1,207 @@
-# db.py — SQLite: init, CRUD, auth, hashing PBKDF2 + entidad items
-import sqlite3, os, hashlib, hmac
+# db.py — SQLite: init, CRUD, auth, hashing Argon2id (scrypt / PBKDF2 de respaldo) + entidad items
+import sqlite3, os, hashlib, hmac, secrets, threading, time, atexit, warnings
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 import pandas as pd
+import streamlit as st
 
 DB_PATH = Path("app.db")
 
-# Hashing PBKDF2
-PBKDF2_ALGO = "sha256"
-PBKDF2_ITERATIONS = 200_000
+def _cpu_has_sha_ext() -> bool:
+    """True si la CPU declara instrucciones SHA-256 (x86 sha_ni / ARMv8 sha2) en /proc/cpuinfo."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    return not {"sha_ni", "sha2"}.isdisjoint(line.split())
+    except OSError:
+        pass
+    return False
+
+# Hashing PBKDF2 (filas legadas; fallback si hashlib no trae scrypt)
+# Con extensiones SHA, OpenSSL acelera SHA-256 por hardware; sin ellas SHA-512 (palabras de
+# 64 bits) rinde más por byte en núcleos escalares de 64 bits
+PBKDF2_ALGO = ("sha256" if _cpu_has_sha_ext() or "sha512" not in hashlib.algorithms_available
+               else "sha512")
+PBKDF2_KDF = f"pbkdf2_{PBKDF2_ALGO}"   # valor de users.kdf para los hashes nuevos
+PBKDF2_ITERATIONS = 200_000        # coste de las filas anteriores a la columna iters
+PBKDF2_MIN_ITERATIONS = 100_000
+PBKDF2_TARGET_MS = 250             # objetivo por hash en login interactivo
+PBKDF2_COST_FILE = Path(f".pbkdf2_{PBKDF2_ALGO}_cost")
+# users.kdf → algoritmo de hashlib; las filas anteriores a la columna son pbkdf2_sha256
+_PBKDF2_KDFS = {"pbkdf2_sha256": "sha256", "pbkdf2_sha512": "sha512"}
 SALT_BYTES = 16
+# Hashing scrypt (fallback sin argon2-cffi): memory-hard, 16 MiB con N=2**14, r=8
+KDF_SCRYPT = "scrypt"
+SCRYPT_N, SCRYPT_R, SCRYPT_P, SCRYPT_DKLEN = 2**14, 8, 1, 32
+SCRYPT_PARAMS = f"n={SCRYPT_N},r={SCRYPT_R},p={SCRYPT_P}"   # valor de users.kdf_params
+_HAS_SCRYPT = hasattr(hashlib, "scrypt")  # requiere OpenSSL ≥ 1.1
+# hashlib.pbkdf2_hmac / scrypt sueltan el GIL: los hashes van a un pool pequeño y acotado
+_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="kdf")
+
+# PBKDF2 en C optimizado (opcional: pip install fastpbkdf2); misma firma que hashlib
+try:
+    from fastpbkdf2 import pbkdf2_hmac as _pbkdf2_hmac
+except ImportError:
+    _pbkdf2_hmac = hashlib.pbkdf2_hmac
+
+# Hashing Argon2id (OWASP: t=3, m=64 MiB, p=2); opcional: pip install argon2-cffi
+try:
+    from argon2 import PasswordHasher, Type
+    from argon2.exceptions import VerificationError, InvalidHashError
+    _PH = PasswordHasher(time_cost=3, memory_cost=65536, parallelism=2,
+                         hash_len=32, salt_len=16, type=Type.ID)
+except ImportError:
+    _PH = None
+KDF_ARGON2 = "argon2id"
+ARGON2_PREFIX = b"$argon2"
+
+_UTC = timezone.utc
+
+def _utc_now_iso(ns: int | None = None) -> str:
+    """ISO-8601 UTC (ms, como _SQL_NOW_ISO) a partir de time.time_ns(); para marcas que deben coincidir entre columnas."""
+    return datetime.fromtimestamp((ns or time.time_ns()) / 1e9, _UTC).isoformat(timespec="milliseconds")
+
+# Marcas de UPDATE calculadas por SQLite ('now' es estable dentro de una sentencia)
+_SQL_NOW_ISO = "strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')"
+_SQL_NOW_TS = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+_write_lock = threading.Lock()
+
+@st.cache_resource
+def _conn() -> sqlite3.Connection:
+    # Una sola conexión por proceso (autocommit), reutilizada entre reruns y sesiones
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=256)
+    conn.row_factory = sqlite3.Row  # filas con acceso por nombre implementado en C
+    # page_size solo aplica al crear el fichero (antes de pasar a WAL); el resto es por conexión
+    conn.execute("PRAGMA page_size=4096")
+    # journal_mode devuelve el modo resultante: en ubicaciones de solo lectura o red puede no ser WAL
+    mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    if str(mode).lower() != "wal":
+        warnings.warn(f"SQLite no pudo activar WAL en {DB_PATH} (journal_mode={mode}); "
+                      "las lecturas se bloquearán durante las escrituras", RuntimeWarning)
+    conn.executescript("""
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-64000;
+        PRAGMA mmap_size=268435456;
+        PRAGMA wal_autocheckpoint=1000;
+    """)
+    atexit.register(conn.close)  # checkpoint del WAL al salir del proceso
+    return conn
 
 def get_conn():
-    return sqlite3.connect(DB_PATH)
+    return _conn()
+
+@contextmanager
+def _write_txn():
+    """Transacción de escritura (BEGIN IMMEDIATE … COMMIT) serializada sobre la conexión compartida.
+
+    Compromiso aceptado: las lecturas usan la misma conexión sin _write_lock, así que una lectura
+    concurrente puede ver filas aún sin confirmar de otra sesión (o abortar si esta hace ROLLBACK).
+    """
+    conn = get_conn()
+    with _write_lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            # Si falla el propio COMMIT (disco lleno, E/S) la transacción sigue abierta: se deshace
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
 
 def db_path() -> str:
     return str(DB_PATH.resolve())
 
+# Filas como tuplas con nombre: acceso por atributo (índice de tupla) sin un dict por fila
+UserRow = namedtuple("UserRow", "id username role salt password_hash iters kdf kdf_params failed_attempts "
+                                "lock_until_ts password_last_set_ts created_at updated_at lock_state")
+ItemRow = namedtuple("ItemRow", "id created_by source title brand price origin material category "
+                                "image_path label_image_path thumb_path co2_estimate co2_level status "
+                                "action_type second_hand_price savings color confidence created_at updated_at")
+_USER_COLS = ", ".join(UserRow._fields[:-1])   # lock_state se calcula en la consulta
+_ITEM_COLS = ", ".join(ItemRow._fields)
+
+# =========================
+# Sentencias SQL (texto fijo → sqlite3 reutiliza la sentencia preparada de su caché)
+# =========================
+# Estado del bloqueo resuelto por SQLite (sin fechas en Python): UserRow.lock_state
+LOCK_NONE, LOCK_ACTIVE, LOCK_EXPIRED = 0, 1, 2
+_SQL_LOCK_STATE = f"""
+    CASE WHEN lock_until_ts IS NULL THEN {LOCK_NONE}
+         WHEN lock_until_ts <= {_SQL_NOW_TS} THEN {LOCK_EXPIRED}
+         ELSE {LOCK_ACTIVE} END"""
+# Búsqueda por el índice UNIQUE de username (una fila: autoíndice + acceso por rowid)
+_SQL_GET_USER = (f"SELECT {_USER_COLS}, {_SQL_LOCK_STATE} AS lock_state "
+                 "FROM users WHERE username = ?")
+_INSERT_USER_TMPL = """
+    INSERT {or_ignore}INTO users (username, role, salt, password_hash, iters, kdf, kdf_params,
+                                  failed_attempts, lock_until_ts, password_last_set_ts,
+                                  created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, 0, NULL, ?, ?, ?)
+"""
+_SQL_INSERT_USER = _INSERT_USER_TMPL.format(or_ignore="")
+_SQL_SEED_USER = _INSERT_USER_TMPL.format(or_ignore="OR IGNORE ")   # UNIQUE(username) descarta existentes
+_SQL_REHASH = f"""
+    UPDATE users SET salt = ?, password_hash = ?, iters = ?, kdf = ?, kdf_params = ?,
+                     updated_at = {_SQL_NOW_ISO}
+    WHERE username = ?
+"""
+_SQL_SET_PASSWORD = f"""
+    UPDATE users SET salt = ?, password_hash = ?, iters = ?, kdf = ?, kdf_params = ?,
+                     password_last_set_ts = {_SQL_NOW_TS}, updated_at = {_SQL_NOW_ISO}
+    WHERE username = ?
+    RETURNING role
+"""
+# Resultado de un intento de login: contador + bloqueo en una sola sentencia (SET ve los valores previos)
+_SQL_LOGIN_RESULT = f"""
+    UPDATE users SET
+        failed_attempts = CASE WHEN :ok THEN 0 ELSE failed_attempts + 1 END,
+        lock_until_ts = CASE WHEN :ok THEN NULL
+                             WHEN failed_attempts + 1 >= :max THEN {_SQL_NOW_TS} + :lock_secs
+                             ELSE lock_until_ts END,
+        updated_at = {_SQL_NOW_ISO}
+    WHERE username = :u
+    RETURNING failed_attempts, lock_until_ts
+"""
+_SQL_CLEAR_EXPIRED_LOCK = f"""
+    UPDATE users SET failed_attempts = 0, lock_until_ts = NULL, updated_at = {_SQL_NOW_ISO}
+    WHERE username = ? AND lock_until_ts IS NOT NULL AND lock_until_ts <= {_SQL_NOW_TS}
+    RETURNING 1
+"""
+_SQL_GET_ITEM = f"SELECT {_ITEM_COLS} FROM items WHERE id = ?"
+_SQL_INSERT_ITEM = """
+    INSERT INTO items (created_by, source, title, brand, price, origin, material, category,
+                       image_path, label_image_path, thumb_path, co2_estimate, co2_level, status,
+                       action_type, second_hand_price, savings, color, confidence, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_SQL_USER_TOTALS = """
+    SELECT status, COUNT(*), COALESCE(SUM(savings), 0), COALESCE(SUM(price), 0),
+           COALESCE(SUM(co2_estimate), 0)
+    FROM items
+    WHERE created_by = ?
+    GROUP BY status
+"""
+
 # =========================
 # Init DB (users + items)
 # =========================
+_initialized = False
+
 def init_db():
-    with get_conn() as conn:
-        try:
-            conn.execute("PRAGMA journal_mode=WAL;")
-        except Exception:
-            pass
+    global _initialized
+    if _initialized:
+        return
+    compact = False
+    with _write_txn() as conn:
         c = conn.cursor()
         # Tabla usuarios
         c.execute("""
@@ -33,11 +209,14 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
             role TEXT NOT NULL DEFAULT 'Viewer',
-            salt_hex TEXT NOT NULL,
-            password_hash_hex TEXT NOT NULL,
+            salt BLOB,
+            password_hash BLOB NOT NULL,
+            iters INTEGER,
+            kdf TEXT,
+            kdf_params TEXT,
             failed_attempts INTEGER NOT NULL DEFAULT 0,
-            lock_until TEXT,
-            password_last_set TEXT,
+            lock_until_ts INTEGER,
+            password_last_set_ts INTEGER,
             created_at TEXT DEFAULT (datetime('now')),
             updated_at TEXT
         )
@@ -56,6 +235,7 @@ def init_db():
             category TEXT,
             image_path TEXT,
             label_image_path TEXT,
+            thumb_path TEXT,
             co2_estimate REAL,
             co2_level TEXT CHECK(co2_level IN ('low','medium','high')),
             status TEXT CHECK(status IN ('in_cart','positive','negative')) NOT NULL DEFAULT 'in_cart',
@@ -68,232 +248,430 @@ def init_db():
             updated_at TEXT
         )
         """)
-        conn.commit()
+        # Listados por usuario/status ya ordenados por fecha (sin paso de ORDER BY)
+        c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_items_createdby_status_created
+            ON items(created_by, status, created_at DESC)
+        """)
+        # Migraciones de columnas añadidas después de crear la tabla
+        _ensure_column(c, "items", "thumb_path", "TEXT")
+        if _ensure_column(c, "users", "iters", "INTEGER"):
+            c.execute("UPDATE users SET iters = ? WHERE password_hash_hex NOT LIKE '$argon2%'",
+                      (PBKDF2_ITERATIONS,))
+        # salt_hex / password_hash_hex (TEXT hex) → salt / password_hash (BLOB)
+        if _ensure_column(c, "users", "password_hash", "BLOB"):
+            _ensure_column(c, "users", "salt", "BLOB")
+            c.execute("SELECT id, salt_hex, password_hash_hex FROM users")
+            c.executemany("UPDATE users SET salt = ?, password_hash = ? WHERE id = ?",
+                          [_hex_to_blob(salt_hex, hash_hex) + (uid,)
+                           for uid, salt_hex, hash_hex in c.fetchall()])
+            c.execute("ALTER TABLE users DROP COLUMN salt_hex")
+            c.execute("ALTER TABLE users DROP COLUMN password_hash_hex")
+            compact = True
+        if _ensure_column(c, "users", "kdf", "TEXT"):
+            c.execute("""
+                UPDATE users SET kdf = CASE WHEN substr(password_hash, 1, ?) = ? THEN ? ELSE 'pbkdf2_sha256' END
+            """, (len(ARGON2_PREFIX), ARGON2_PREFIX, KDF_ARGON2))
+        _ensure_column(c, "users", "kdf_params", "TEXT")
+        # lock_until / password_last_set (ISO TEXT) → epoch INTEGER; se eliminan las TEXT como las hex
+        if _ensure_column(c, "users", "lock_until_ts", "INTEGER"):
+            c.execute("UPDATE users SET lock_until_ts = CAST(strftime('%s', lock_until) AS INTEGER)")
+        if _ensure_column(c, "users", "password_last_set_ts", "INTEGER"):
+            c.execute("UPDATE users SET password_last_set_ts = CAST(strftime('%s', password_last_set) AS INTEGER)")
+        # También en bases ya migradas antes de que se eliminaran (esquema igual al de una base nueva)
+        for old_col in ("lock_until", "password_last_set"):
+            compact |= _drop_column(c, "users", old_col)
+        # El antiguo índice "cubriente" copiaba sal/hash y se reescribía en cada intento de login
+        c.execute("DROP INDEX IF EXISTS idx_users_auth")
+    # Tras eliminar columnas (hex TEXT → BLOB, fechas ISO → epoch), VACUUM devuelve las páginas liberadas (no admite transacción abierta)
+    if compact:
+        get_conn().execute("VACUUM")
+    # Calibrar PBKDF2 al arrancar (no en el primer login) si es el esquema activo
+    if _PH is None and not _HAS_SCRYPT:
+        pbkdf2_iterations()
+    _initialized = True
+
+def _hex_to_blob(salt_hex: str, hash_hex: str) -> tuple[bytes | None, bytes]:
+    # Argon2id: la cadena PHC se guarda tal cual (utf-8) y sin sal aparte
+    if hash_hex.startswith("$argon2"):
+        return None, hash_hex.encode("utf-8")
+    return bytes.fromhex(salt_hex), bytes.fromhex(hash_hex)
+
+def _ensure_column(cur, table: str, column: str, decl: str) -> bool:
+    """Añade la columna si falta; True si se ha creado ahora."""
+    cur.execute(f"PRAGMA table_info({table})")
+    if column in {row[1] for row in cur.fetchall()}:
+        return False
+    cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+def _drop_column(cur, table: str, column: str) -> bool:
+    """Elimina la columna si existe; True si se ha eliminado ahora."""
+    cur.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cur.fetchall()}:
+        return False
+    cur.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+    return True
 
 # =========================
 # Hash helpers
 # =========================
-def _hash_password(password: str) -> tuple[str, str]:
-    salt = os.urandom(SALT_BYTES)
-    pwd = hashlib.pbkdf2_hmac(PBKDF2_ALGO, password.encode("utf-8"), salt, PBKDF2_ITERATIONS)
-    return salt.hex(), pwd.hex()
+def benchmark_iterations(target_ms: int = PBKDF2_TARGET_MS) -> int:
+    """Iteraciones PBKDF2 que tardan ~target_ms en esta máquina (nunca menos de PBKDF2_MIN_ITERATIONS)."""
+    n = 50_000
+    t0 = time.perf_counter()
+    _pbkdf2_hmac(PBKDF2_ALGO, b"x", b"y" * SALT_BYTES, n)
+    dt = time.perf_counter() - t0
+    return max(int(n * target_ms / 1000 / dt), PBKDF2_MIN_ITERATIONS)
+
+@lru_cache(maxsize=1)
+def pbkdf2_iterations() -> int:
+    """Coste PBKDF2 de esta máquina: benchmark_iterations() una vez, cacheado en disco."""
+    try:
+        return max(int(PBKDF2_COST_FILE.read_text()), PBKDF2_MIN_ITERATIONS)
+    except (OSError, ValueError):
+        pass
+    iters = benchmark_iterations()
+    try:
+        PBKDF2_COST_FILE.write_text(str(iters))
+    except OSError:
+        pass
+    return iters
+
+# Alias a nivel de módulo: el camino de login evita LOAD_GLOBAL + LOAD_ATTR por llamada
+_scrypt_kdf = getattr(hashlib, "scrypt", None)
+_cd = hmac.compare_digest
+_urandom = os.urandom
+_token_bytes = secrets.token_bytes
+
+# (salt, password_hash, iters, kdf, kdf_params) tal como se guardan en users
+_Hashed = tuple[bytes | None, bytes, int | None, str, str | None]
+
+def _run(fn, *args, offload: bool = True, **kwargs):
+    # offload=False: el llamante ya es un hilo de trabajo (evita anidar tareas en _POOL)
+    return _POOL.submit(fn, *args, **kwargs).result() if offload else fn(*args, **kwargs)
+
+def _pbkdf2(password: str, salt: bytes, iters: int, algo: str = PBKDF2_ALGO,
+            offload: bool = True) -> bytes:
+    return _run(_pbkdf2_hmac, algo, password.encode("utf-8"), salt, iters, offload=offload)
+
+@lru_cache(maxsize=8)
+def _scrypt_params(params: str) -> tuple[int, int, int]:
+    kv = dict(item.split("=") for item in params.split(","))
+    return int(kv["n"]), int(kv["r"]), int(kv["p"])
+
+def _scrypt(password: str, salt: bytes, params: str, offload: bool = True) -> bytes:
+    n, r, p = _scrypt_params(params)
+    return _run(_scrypt_kdf, password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                maxmem=2 * 128 * r * n * p + 2**20, dklen=SCRYPT_DKLEN, offload=offload)
+
+def _hash_password(password: str, offload: bool = True, salt: bytes | None = None) -> _Hashed:
+    # Argon2id guarda sal y parámetros en la cadena PHC → sin sal aparte, sin iters
+    if _PH is not None:
+        return None, _PH.hash(password).encode("utf-8"), None, KDF_ARGON2, None
+    salt = salt or _token_bytes(SALT_BYTES)
+    if _HAS_SCRYPT:
+        return salt, _scrypt(password, salt, SCRYPT_PARAMS, offload), None, KDF_SCRYPT, SCRYPT_PARAMS
+    iters = pbkdf2_iterations()
+    return salt, _pbkdf2(password, salt, iters, offload=offload), iters, PBKDF2_KDF, None
 
-def _verify_password(password: str, salt_hex: str, hash_hex: str) -> bool:
-    salt = bytes.fromhex(salt_hex)
-    expected = bytes.fromhex(hash_hex)
-    got = hashlib.pbkdf2_hmac(PBKDF2_ALGO, password.encode("utf-8"), salt, PBKDF2_ITERATIONS)
-    return hmac.compare_digest(got, expected)
+def _hash_many(passwords: list[str]) -> list[_Hashed]:
+    """Hashea un lote de contraseñas en paralelo (un hilo por núcleo); mismo orden que la entrada."""
+    if len(passwords) <= 1:
+        return [_hash_password(pw) for pw in passwords]
+    # Todas las sales en una sola lectura de urandom, troceada por usuario
+    buf = _urandom(SALT_BYTES * len(passwords))
+    salts = [buf[i:i + SALT_BYTES] for i in range(0, len(buf), SALT_BYTES)]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        return list(pool.map(lambda pw, salt: _hash_password(pw, offload=False, salt=salt),
+                             passwords, salts))
+
+def _verify_password(password: str, salt: bytes | None, pwd_hash: bytes, iters: int | None,
+                     kdf: str | None, kdf_params: str | None = None) -> bool:
+    if kdf == KDF_ARGON2:
+        if _PH is None:
+            return False
+        try:
+            return _PH.verify(pwd_hash.decode("utf-8"), password)
+        except (VerificationError, InvalidHashError):
+            return False
+    if kdf == KDF_SCRYPT:
+        return _HAS_SCRYPT and _cd(_scrypt(password, salt, kdf_params), pwd_hash)
+    algo = _PBKDF2_KDFS.get(kdf or "pbkdf2_sha256")
+    if algo is None:
+        return False
+    return _cd(_pbkdf2(password, salt, iters or PBKDF2_ITERATIONS, algo), pwd_hash)
+
+def _needs_rehash(kdf: str | None, pwd_hash: bytes, iters: int | None,
+                  kdf_params: str | None = None) -> bool:
+    """True si el hash no usa el esquema/coste actual (Argon2; si no, scrypt; si no, PBKDF2 calibrado)."""
+    if _PH is None and _HAS_SCRYPT:
+        return kdf != KDF_SCRYPT or kdf_params != SCRYPT_PARAMS
+    if _PH is None:
+        return kdf != PBKDF2_KDF or (iters or 0) < pbkdf2_iterations()
+    if kdf != KDF_ARGON2:
+        return True
+    try:
+        return _PH.check_needs_rehash(pwd_hash.decode("utf-8"))
+    except InvalidHashError:
+        return True
 
 # =========================
 # Users CRUD / Auth
 # =========================
-def _user_row_to_dict(row):
-    if not row:
-        return None
-    cols = ["id","username","role","salt_hex","password_hash_hex","failed_attempts",
-            "lock_until","password_last_set","created_at","updated_at"]
-    return dict(zip(cols, row))
-
-def get_user(username: str) -> dict | None:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT id, username, role, salt_hex, password_hash_hex, failed_attempts,
-                   lock_until, password_last_set, created_at, updated_at
-            FROM users WHERE username = ?
-        """, (username,))
-        return _user_row_to_dict(cur.fetchone())
+USER_CACHE_TTL_SECONDS = 1.0   # ≤ 1 s: lock_until_ts / failed_attempts no pueden quedar obsoletos más
+USER_CACHE_MAXSIZE = 1024
+_user_cache: dict[str, tuple[float, UserRow]] = {}
+_cache_lock = threading.Lock()
+
+def _invalidate_user(username: str):
+    with _cache_lock:
+        _user_cache.pop(username, None)
+
+def get_user(username: str) -> UserRow | None:
+    # Caché corta: un mismo login consulta al usuario varias veces seguidas
+    with _cache_lock:
+        hit = _user_cache.get(username)
+    if hit and time.monotonic() - hit[0] < USER_CACHE_TTL_SECONDS:
+        return hit[1]
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(_SQL_GET_USER, (username,))
+    u = UserRow._make(row) if (row := cur.fetchone()) else None
+    if u:
+        with _cache_lock:
+            _user_cache.pop(username, None)
+            if len(_user_cache) >= USER_CACHE_MAXSIZE:
+                del _user_cache[next(iter(_user_cache))]  # el más antiguo (orden de inserción)
+            _user_cache[username] = (time.monotonic(), u)
+    return u
 
 def create_user(username: str, password: str, role: str = "Viewer") -> tuple[bool, str | None]:
     try:
-        salt, pwh = _hash_password(password)
-        now = datetime.now(timezone.utc).isoformat()
-        with get_conn() as conn:
+        salt, pwh, iters, kdf, kdf_params = _hash_password(password)
+        ns = time.time_ns()
+        now = _utc_now_iso(ns)
+        with _write_txn() as conn:
             cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO users (username, role, salt_hex, password_hash_hex,
-                                   failed_attempts, lock_until, password_last_set,
-                                   created_at, updated_at)
-                VALUES (?, ?, ?, ?, 0, NULL, ?, ?, ?)
-            """, (username, role, salt, pwh, now, now, now))
-            conn.commit()
+            cur.execute(_SQL_INSERT_USER, (username, role, salt, pwh, iters, kdf, kdf_params, ns // 1_000_000_000, now, now))
+        _invalidate_user(username)
         return True, None
     except sqlite3.IntegrityError:
         return False, "El usuario ya existe."
     except Exception as e:
         return False, f"Error al crear usuario: {e}"
 
-def authenticate(username: str, password: str) -> tuple[bool, dict | None]:
-    u = get_user(username)
+def authenticate(username: str, password: str, user_data: UserRow | None = None) -> tuple[bool, UserRow | None]:
+    u = user_data or get_user(username)
     if not u:
         return False, None
-    ok = _verify_password(password, u["salt_hex"], u["password_hash_hex"])
+    ok = _verify_password(password, u.salt, u.password_hash, u.iters, u.kdf, u.kdf_params)
+    if ok and _needs_rehash(u.kdf, u.password_hash, u.iters, u.kdf_params):
+        _rehash_password(username, password)
     return ok, u if ok else None
 
-def register_failed_attempt(username: str, max_attempts: int, lock_minutes: int):
-    u = get_user(username)
-    if not u:
-        return
-    fa = int(u.get("failed_attempts") or 0) + 1
-    lock_until = u.get("lock_until")
-    if fa >= max_attempts:
-        lock_until = (datetime.now(timezone.utc) + timedelta(minutes=lock_minutes)).isoformat()
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE users SET failed_attempts = ?, lock_until = ?, updated_at = ?
-            WHERE username = ?
-        """, (fa, lock_until, datetime.now(timezone.utc).isoformat(), username))
-        conn.commit()
+def _rehash_password(username: str, password: str):
+    """Actualiza el hash al esquema actual sin tocar password_last_set_ts (no reinicia la caducidad)."""
+    salt, pwh, iters, kdf, kdf_params = _hash_password(password)
+    with _write_txn() as conn:
+        conn.execute(_SQL_REHASH, (salt, pwh, iters, kdf, kdf_params, username))
+    _invalidate_user(username)
+
+def _execute_login_txn(username: str, success: bool, max_attempts: int = 0,
+                       lock_minutes: int = 0) -> tuple[int, int | None] | None:
+    """Aplica el resultado del login y devuelve (failed_attempts, lock_until_ts) tras el cambio."""
+    with _write_txn() as conn:
+        rows = conn.execute(_SQL_LOGIN_RESULT, {
+            "ok": success, "max": max_attempts, "lock_secs": lock_minutes * 60, "u": username,
+        }).fetchall()
+    _invalidate_user(username)
+    return tuple(rows[0]) if rows else None
+
+def register_failed_attempt(username: str, max_attempts: int, lock_minutes: int) -> tuple[int, int | None] | None:
+    return _execute_login_txn(username, False, max_attempts, lock_minutes)
 
 def reset_failed_attempts(username: str):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE users SET failed_attempts = 0, lock_until = NULL, updated_at = ?
-            WHERE username = ?
-        """, (datetime.now(timezone.utc).isoformat(), username))
-        conn.commit()
-
-def set_new_password(username: str, new_password: str):
-    salt, pwh = _hash_password(new_password)
-    now = datetime.now(timezone.utc).isoformat()
-    with get_conn() as conn:
+    _execute_login_txn(username, True)
+
+def clear_lock_if_expired(username: str) -> bool:
+    """Levanta el bloqueo solo si ya ha vencido (comparado en SQL); True si lo ha levantado."""
+    with _write_txn() as conn:
+        cleared = conn.execute(_SQL_CLEAR_EXPIRED_LOCK, (username,)).fetchall()
+    if cleared:
+        _invalidate_user(username)
+    return bool(cleared)
+
+def set_new_password(username: str, new_password: str) -> str | None:
+    """Cambia la contraseña y devuelve el rol del usuario (None si no existe)."""
+    salt, pwh, iters, kdf, kdf_params = _hash_password(new_password)
+    with _write_txn() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            UPDATE users SET salt_hex = ?, password_hash_hex = ?,
-                            password_last_set = ?, updated_at = ?
-            WHERE username = ?
-        """, (salt, pwh, now, now, username))
-        conn.commit()
+        cur.execute(_SQL_SET_PASSWORD, (salt, pwh, iters, kdf, kdf_params, username))
+        rows = cur.fetchall()
+    _invalidate_user(username)
+    return rows[0]["role"] if rows else None
 
 def seed_initial_users(seed: dict):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        for username, info in seed.items():
-            cur.execute("SELECT 1 FROM users WHERE username = ?", (username,))
-            if cur.fetchone():
-                continue
-            salt, pwh = _hash_password(info["password"])
-            now = datetime.now(timezone.utc).isoformat()
-            cur.execute("""
-                INSERT INTO users (username, role, salt_hex, password_hash_hex,
-                                   failed_attempts, lock_until, password_last_set,
-                                   created_at, updated_at)
-                VALUES (?, ?, ?, ?, 0, NULL, ?, ?, ?)
-            """, (username, info.get("role","Viewer"), salt, pwh, now, now, now))
-        conn.commit()
+    # Una sola consulta IN (...) descarta los ya existentes: no se hashea lo que no se va a insertar
+    if not seed:
+        return
+    cur = get_conn().execute(
+        f"SELECT username FROM users WHERE username IN ({', '.join('?' * len(seed))})", list(seed))
+    existing = {row[0] for row in cur.fetchall()}
+    pending = [(username, info) for username, info in seed.items() if username not in existing]
+    if not pending:
+        return
+    ns = time.time_ns()
+    now = _utc_now_iso(ns)
+    # Hashes en paralelo y fuera de la transacción (PBKDF2/Argon2 sueltan el GIL)
+    hashes = _hash_many([info["password"] for _, info in pending])
+    rows = [(username, info.get("role","Viewer"), *h,
+             ns // 1_000_000_000, now, now)
+            for (username, info), h in zip(pending, hashes)]
+    with _write_txn() as conn:
+        conn.executemany(_SQL_SEED_USER, rows)
+
+# Tipos Arrow explícitos: st.dataframe los serializa sin convertir columnas object
+_USERS_DF_DTYPES = {
+    "id": "int64[pyarrow]", "username": "string[pyarrow]", "role": "string[pyarrow]",
+    "failed_attempts": "int64[pyarrow]", "lock_until": "string[pyarrow]",
+    "password_last_set": "string[pyarrow]", "created_at": "string[pyarrow]",
+}
 
 def list_users_df() -> pd.DataFrame:
-    with get_conn() as conn:
-        df = pd.read_sql_query("""
-            SELECT id, username, role, failed_attempts, lock_until, password_last_set, created_at
-            FROM users ORDER BY id
-        """, conn)
+    conn = get_conn()
+    df = pd.read_sql_query("""
+        SELECT id, username, role, failed_attempts,
+               datetime(lock_until_ts, 'unixepoch') AS lock_until,
+               datetime(password_last_set_ts, 'unixepoch') AS password_last_set, created_at
+        FROM users ORDER BY id
+    """, conn, dtype=_USERS_DF_DTYPES, dtype_backend="pyarrow")
     return df
 
 def count_users() -> int:
-    with get_conn() as conn:
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM users")
-        return c.fetchone()[0]
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM users")
+    return c.fetchone()[0]
 
 # =========================
 # Items CRUD
 # =========================
-def _item_row_to_dict(row):
-    if not row:
-        return None
-    cols = [
-        "id", "created_by", "source", "title", "brand", "price", "origin", "material",
-        "category", "image_path", "label_image_path", "co2_estimate", "co2_level",
-        "status", "action_type", "second_hand_price", "savings", "color", "confidence",
-        "created_at", "updated_at"
-    ]
-    return dict(zip(cols, row))
-
 def create_item(created_by: str, source: str, title: str, price: float,
                 brand: str | None = None, origin: str | None = None,
                 material: str | None = None, category: str | None = None,
                 image_path: str | None = None, label_image_path: str | None = None,
+                thumb_path: str | None = None,
                 co2_estimate: float | None = None, co2_level: str | None = None,
                 status: str = "in_cart", action_type: str = "none",
                 second_hand_price: float | None = None, savings: float | None = None,
                 color: str | None = None, confidence: float | None = None) -> int:
-    now = datetime.now(timezone.utc).isoformat()
-    with get_conn() as conn:
+    now = _utc_now_iso()
+    with _write_txn() as conn:
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO items (created_by, source, title, brand, price, origin, material, category,
-                               image_path, label_image_path, co2_estimate, co2_level, status, action_type,
-                               second_hand_price, savings, color, confidence, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (created_by, source, title, brand, price, origin, material, category,
-              image_path, label_image_path, co2_estimate, co2_level, status, action_type,
-              second_hand_price, savings, color, confidence, now, now))
-        conn.commit()
+        cur.execute(_SQL_INSERT_ITEM, (created_by, source, title, brand, price, origin, material, category,
+              image_path, label_image_path, thumb_path, co2_estimate, co2_level, status,
+              action_type, second_hand_price, savings, color, confidence, now, now))
         return cur.lastrowid
 
-def get_item(item_id: int) -> dict | None:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT id, created_by, source, title, brand, price, origin, material, category,
-                   image_path, label_image_path, co2_estimate, co2_level, status, action_type,
-                   second_hand_price, savings, color, confidence, created_at, updated_at
-            FROM items WHERE id = ?
-        """, (item_id,))
-        return _item_row_to_dict(cur.fetchone())
+def get_item(item_id: int) -> ItemRow | None:
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(_SQL_GET_ITEM, (item_id,))
+    return ItemRow._make(row) if (row := cur.fetchone()) else None
+
+_ITEM_UPDATABLE = frozenset({
+    "source", "title", "brand", "price", "origin", "material", "category",
+    "image_path", "label_image_path", "thumb_path", "co2_estimate", "co2_level",
+    "status", "action_type", "second_hand_price", "savings", "color", "confidence",
+})
+
+@lru_cache(maxsize=64)
+def _update_item_sql(keys: tuple[str, ...]) -> str:
+    # Mismo texto SQL por combinación de columnas → reutiliza la sentencia preparada de sqlite3
+    return f"UPDATE items SET {', '.join(f'{k} = ?' for k in keys)}, updated_at = {_SQL_NOW_ISO} WHERE id = ?"
 
 def update_item(item_id: int, **fields):
     if not fields:
         return
-    fields["updated_at"] = datetime.now(timezone.utc).isoformat()
-    keys = ", ".join([f"{k} = ?" for k in fields.keys()])
-    vals = list(fields.values())
+    unknown = fields.keys() - _ITEM_UPDATABLE
+    if unknown:
+        raise ValueError(f"Columnas no permitidas: {sorted(unknown)}")
+    keys = tuple(sorted(fields))
+    vals = [fields[k] for k in keys]
     vals.append(item_id)
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(f"UPDATE items SET {keys} WHERE id = ?", vals)
-        conn.commit()
+    with _write_txn() as conn:
+        conn.execute(_update_item_sql(keys), vals)
 
-def list_user_items(username: str, status: str | None = None, order_by: str = "-created_at") -> list[dict]:
+def list_user_items(username: str, status: str | None = None, order_by: str = "-created_at",
+                    limit: int | None = None, offset: int = 0) -> list[ItemRow]:
     order_sql = "created_at DESC" if order_by.startswith("-") else "created_at ASC"
-    with get_conn() as conn:
-        cur = conn.cursor()
-        if status:
-            cur.execute(f"""
-                SELECT id, created_by, source, title, brand, price, origin, material, category,
-                       image_path, label_image_path, co2_estimate, co2_level, status, action_type,
-                       second_hand_price, savings, color, confidence, created_at, updated_at
-                FROM items
-                WHERE created_by = ? AND status = ?
-                ORDER BY {order_sql}
-            """, (username, status))
-        else:
-            cur.execute(f"""
-                SELECT id, created_by, source, title, brand, price, origin, material, category,
-                       image_path, label_image_path, co2_estimate, co2_level, status, action_type,
-                       second_hand_price, savings, color, confidence, created_at, updated_at
-                FROM items
-                WHERE created_by = ?
-                ORDER BY {order_sql}
-            """, (username,))
-        rows = cur.fetchall()
-    return [_item_row_to_dict(r) for r in rows]
+    where_sql = "created_by = ? AND status = ?" if status else "created_by = ?"
+    params = [username, status] if status else [username]
+    page_sql = ""
+    if limit is not None:
+        page_sql = "LIMIT ? OFFSET ?"
+        params += [limit, offset]
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT {_ITEM_COLS}
+        FROM items
+        WHERE {where_sql}
+        ORDER BY {order_sql}
+        {page_sql}
+    """, params)
+    return list(map(ItemRow._make, cur.fetchall()))
+
+_EMPTY_TOTALS = {"count": 0, "savings": 0.0, "price": 0.0, "co2": 0.0}
+
+def user_totals(username: str) -> dict[str, dict]:
+    """Agregados (nº items, ahorro, gasto, CO₂) de un usuario por status, en una sola pasada SQL."""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(_SQL_USER_TOTALS, (username,))
+    rows = cur.fetchall()
+    totals = {s: dict(_EMPTY_TOTALS) for s in ("in_cart", "positive", "negative")}
+    for status, n, savings, price, co2 in rows:
+        totals[status] = {"count": n, "savings": savings, "price": price, "co2": co2}
+    return totals
+
+_ITEMS_DF_DTYPES = {
+    "id": "int64[pyarrow]", "created_by": "string[pyarrow]", "source": "string[pyarrow]",
+    "title": "string[pyarrow]", "brand": "string[pyarrow]", "price": "double[pyarrow]",
+    "origin": "string[pyarrow]", "material": "string[pyarrow]", "category": "string[pyarrow]",
+    "co2_estimate": "double[pyarrow]", "co2_level": "string[pyarrow]", "status": "string[pyarrow]",
+    "action_type": "string[pyarrow]", "second_hand_price": "double[pyarrow]",
+    "savings": "double[pyarrow]", "color": "string[pyarrow]", "confidence": "double[pyarrow]",
+    "created_at": "string[pyarrow]",
+}
+
+def list_user_items_df(username: str, status: str, columns: tuple[str, ...]) -> pd.DataFrame:
+    """Items de un usuario/status proyectados a `columns`, leídos de SQL directamente a DataFrame."""
+    unknown = set(columns) - _ITEMS_DF_DTYPES.keys()
+    if unknown:
+        raise ValueError(f"Columnas no permitidas: {sorted(unknown)}")
+    conn = get_conn()
+    return pd.read_sql_query(f"""
+        SELECT {", ".join(columns)}
+        FROM items
+        WHERE created_by = ? AND status = ?
+        ORDER BY created_at DESC
+    """, conn, params=(username, status),
+       dtype={c: _ITEMS_DF_DTYPES[c] for c in columns}, dtype_backend="pyarrow")
 
 def list_items_df() -> pd.DataFrame:
-    with get_conn() as conn:
-        df = pd.read_sql_query("""
-            SELECT id, created_by, source, title, brand, price, origin, material,
-                   category, co2_estimate, co2_level, status, action_type,
-                   second_hand_price, savings, color, confidence, created_at
-            FROM items ORDER BY id
-        """, conn)
+    conn = get_conn()
+    df = pd.read_sql_query("""
+        SELECT id, created_by, source, title, brand, price, origin, material,
+               category, co2_estimate, co2_level, status, action_type,
+               second_hand_price, savings, color, confidence, created_at
+        FROM items ORDER BY id
+    """, conn, dtype=_ITEMS_DF_DTYPES, dtype_backend="pyarrow")
     return df
 
 def count_items() -> int:
-    with get_conn() as conn:
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM items")
-        return c.fetchone()[0]
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM items")
+    return c.fetchone()[0]